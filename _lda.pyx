@@ -4,7 +4,11 @@
 #cython: cdivision=True
 
 from cython.operator cimport preincrement as inc, predecrement as dec
+from cython.parallel cimport parallel, prange
 from libc.stdlib cimport malloc, free
+from libc.string cimport memcpy
+
+cimport openmp
 
 
 cdef extern from "gamma.h":
@@ -18,71 +22,220 @@ cdef double lgamma(double x) nogil:
     return lda_lgamma(x)
 
 
-cdef int searchsorted(double* arr, int length, double value) nogil:
-    """Bisection search (c.f. numpy.searchsorted)
-
-    Find the index into sorted array `arr` of length `length` such that, if
-    `value` were inserted before the index, the order of `arr` would be
-    preserved.
-    """
-    cdef int imin, imax, imid
-    imin = 0
-    imax = length
-    while imin < imax:
-        imid = imin + ((imax - imin) >> 1)
-        if value > arr[imid]:
-            imin = imid + 1
+cdef void _build_alias(double* q, int n, double* prob, int* alias, int* small, int* large) nogil:
+    """Walker's alias method: preprocess the n unnormalized weights in `q`
+    into `prob`/`alias` tables allowing O(1) draws. `small` and `large`
+    are scratch stacks of length n."""
+    cdef int k, a, b
+    cdef int n_small = 0
+    cdef int n_large = 0
+    cdef double q_sum = 0
+    for k in range(n):
+        q_sum += q[k]
+    for k in range(n):
+        prob[k] = q[k] * n / q_sum
+        alias[k] = k
+    for k in range(n):
+        if prob[k] < 1:
+            small[n_small] = k
+            n_small += 1
+        else:
+            large[n_large] = k
+            n_large += 1
+    while n_small > 0 and n_large > 0:
+        n_small -= 1
+        n_large -= 1
+        a = small[n_small]
+        b = large[n_large]
+        alias[a] = b
+        prob[b] = prob[b] + prob[a] - 1
+        if prob[b] < 1:
+            small[n_small] = b
+            n_small += 1
         else:
-            imax = imid
-    return imin
+            large[n_large] = b
+            n_large += 1
+    while n_large > 0:
+        n_large -= 1
+        prob[large[n_large]] = 1
+    while n_small > 0:
+        n_small -= 1
+        prob[small[n_small]] = 1
 
 
-def _sample_topics(int[:] WS, int[:] DS, int[:] ZS, int[:, :] nzw, int[:, :] ndz, int[:] nz,
-                   double[:] alpha, double[:] eta, double[:] rands, double lamda, double[:,:] topic_word_new):
-    cdef int i, k, w, d, z, z_new
-    cdef double r, dist_cum
-    cdef int N = WS.shape[0]
+def _sample_topics(int[::1] WS, int[::1] DS, int[::1] ZS, int[:, ::1] nwz, int[:, ::1] ndz, int[::1] nz,
+                   double[::1] alpha, double[::1] eta, double[::1] rands, double lamda,
+                   float[:, ::1] topic_word_new, int[::1] chunk_starts, int[::1] doc_starts):
+    """Samples all topic assignments, one document chunk per thread.
+
+    Instead of scanning all n_topics weights per token, each token runs a
+    short Metropolis-Hastings chain in the style of LightLDA: a word
+    proposal drawn in O(1) from a per-word alias table built once per
+    sweep, followed by a doc proposal drawn from the document's current
+    assignments. The stale alias weights only shape the proposal; the
+    acceptance ratio uses the live counts, so the chain still targets the
+    exact collapsed conditional.
+
+    `chunk_starts` holds token offsets aligned to document boundaries, so
+    every chunk owns a disjoint set of `ndz` rows. Each thread samples its
+    chunk against a private snapshot of the topic-word counts and then
+    replays its reassignments into the shared counts under a lock
+    (approximate distributed Gibbs sampling, c.f. AD-LDA).
+    """
+    cdef int c, i, j, k, w, d, z, z_new, start, end, s, t, mh, rc, doc_len
+    cdef double u, p_s, p_t, ratio
+    cdef int n_chunks = chunk_starts.shape[0] - 1
     cdef int n_rand = rands.shape[0]
     cdef int n_topics = nz.shape[0]
+    cdef int vocab_size = nwz.shape[0]
     cdef double eta_sum = 0
-    cdef double* dist_sum = <double*> malloc(n_topics * sizeof(double))
-    if dist_sum is NULL:
+    cdef double alpha_sum = 0
+    cdef int* local_nwz
+    cdef int* local_nz
+    cdef int* old_z
+    cdef int* small
+    cdef int* large
+    cdef double* qw = <double*> malloc(<size_t> vocab_size * n_topics * sizeof(double))
+    cdef double* alias_prob = <double*> malloc(<size_t> vocab_size * n_topics * sizeof(double))
+    cdef int* alias_idx = <int*> malloc(<size_t> vocab_size * n_topics * sizeof(int))
+    cdef openmp.omp_lock_t lock
+    if qw is NULL or alias_prob is NULL or alias_idx is NULL:
+        free(qw)
+        free(alias_prob)
+        free(alias_idx)
         raise MemoryError("Could not allocate memory during sampling.")
+    openmp.omp_init_lock(&lock)
     with nogil:
         for i in range(eta.shape[0]):
             eta_sum += eta[i]
+        for k in range(n_topics):
+            alpha_sum += alpha[k]
 
-        for i in range(N):
-            w = WS[i]
-            d = DS[i]
-            z = ZS[i]
+    # build the per-word alias tables from the counts at sweep entry
+    with nogil, parallel():
+        small = <int*> malloc(n_topics * sizeof(int))
+        large = <int*> malloc(n_topics * sizeof(int))
+        if small is NULL or large is NULL:
+            with gil:
+                raise MemoryError("Could not allocate memory during sampling.")
+        for w in prange(vocab_size, schedule='static'):
+            for k in range(n_topics):
+                qw[w * n_topics + k] = lamda * (nwz[w, k] + eta[w]) / (nz[k] + eta_sum) + (1 - lamda) * topic_word_new[k, w]
+            _build_alias(&qw[w * n_topics], n_topics, &alias_prob[w * n_topics], &alias_idx[w * n_topics], small, large)
+        free(small)
+        free(large)
 
-            dec(nzw[z, w])
-            dec(ndz[d, z])
-            dec(nz[z])
+    with nogil, parallel():
+        local_nwz = <int*> malloc(<size_t> n_topics * vocab_size * sizeof(int))
+        local_nz = <int*> malloc(n_topics * sizeof(int))
+        if local_nwz is NULL or local_nz is NULL:
+            with gil:
+                raise MemoryError("Could not allocate memory during sampling.")
 
-            dist_cum = 0
-            for k in range(n_topics):
-                # eta is a double so cdivision yields a double
-                dist_cum += (lamda * (nzw[k, w] + eta[w]) / (nz[k] + eta_sum) + (1 - lamda) * topic_word_new[k, w]) * (ndz[d, k] + alpha[k])
-                dist_sum[k] = dist_cum
+        for c in prange(n_chunks, schedule='dynamic'):
+            start = chunk_starts[c]
+            end = chunk_starts[c + 1]
+            old_z = <int*> malloc((end - start) * sizeof(int))
+            if old_z is NULL:
+                with gil:
+                    raise MemoryError("Could not allocate memory during sampling.")
+
+            # private snapshot of the shared topic-word counts
+            openmp.omp_set_lock(&lock)
+            memcpy(local_nwz, &nwz[0, 0], <size_t> n_topics * vocab_size * sizeof(int))
+            memcpy(local_nz, &nz[0], n_topics * sizeof(int))
+            openmp.omp_unset_lock(&lock)
+
+            rc = start
+            for i in range(start, end):
+                w = WS[i]
+                d = DS[i]
+                z = ZS[i]
+                old_z[i - start] = z
 
-            r = rands[i % n_rand] * dist_cum  # dist_cum == dist_sum[-1]
-            z_new = searchsorted(dist_sum, n_topics, r)
+                dec(local_nwz[w * n_topics + z])
+                dec(ndz[d, z])
+                dec(local_nz[z])
 
-            ZS[i] = z_new
-            inc(nzw[z_new, w])
-            inc(ndz[d, z_new])
-            inc(nz[z_new])
+                s = z
+                p_s = (lamda * (local_nwz[w * n_topics + s] + eta[w]) / (local_nz[s] + eta_sum) + (1 - lamda) * topic_word_new[s, w]) * (ndz[d, s] + alpha[s])
+                for mh in range(2):
+                    if mh == 0:
+                        # word proposal: O(1) draw from the alias table
+                        u = rands[rc % n_rand]
+                        rc = rc + 1
+                        j = <int> (u * n_topics)
+                        if j >= n_topics:
+                            j = n_topics - 1
+                        u = rands[rc % n_rand]
+                        rc = rc + 1
+                        if u < alias_prob[w * n_topics + j]:
+                            t = j
+                        else:
+                            t = alias_idx[w * n_topics + j]
+                        if t == s:
+                            continue
+                        p_t = (lamda * (local_nwz[w * n_topics + t] + eta[w]) / (local_nz[t] + eta_sum) + (1 - lamda) * topic_word_new[t, w]) * (ndz[d, t] + alpha[t])
+                        ratio = p_t * qw[w * n_topics + s] / (p_s * qw[w * n_topics + t])
+                    else:
+                        # doc proposal: a random token of d, or alpha-uniform
+                        doc_len = doc_starts[d + 1] - doc_starts[d]
+                        u = rands[rc % n_rand]
+                        rc = rc + 1
+                        if u * (doc_len + alpha_sum) < doc_len:
+                            u = rands[rc % n_rand]
+                            rc = rc + 1
+                            j = doc_starts[d] + <int> (u * doc_len)
+                            if j >= doc_starts[d + 1]:
+                                j = doc_starts[d + 1] - 1
+                            t = ZS[j]
+                        else:
+                            u = rands[rc % n_rand]
+                            rc = rc + 1
+                            t = <int> (u * n_topics)
+                            if t >= n_topics:
+                                t = n_topics - 1
+                        if t == s:
+                            continue
+                        p_t = (lamda * (local_nwz[w * n_topics + t] + eta[w]) / (local_nz[t] + eta_sum) + (1 - lamda) * topic_word_new[t, w]) * (ndz[d, t] + alpha[t])
+                        # the doc factor of the proposal cancels against p
+                        ratio = p_t * (ndz[d, s] + alpha[s]) / (p_s * (ndz[d, t] + alpha[t]))
+                    u = rands[rc % n_rand]
+                    rc = rc + 1
+                    if u < ratio:
+                        s = t
+                        p_s = p_t
 
-        free(dist_sum)
+                z_new = s
+                ZS[i] = z_new
+                inc(local_nwz[w * n_topics + z_new])
+                inc(ndz[d, z_new])
+                inc(local_nz[z_new])
 
+            # replay this chunk's reassignments into the shared counts
+            openmp.omp_set_lock(&lock)
+            for i in range(start, end):
+                w = WS[i]
+                dec(nwz[w, old_z[i - start]])
+                dec(nz[old_z[i - start]])
+                inc(nwz[w, ZS[i]])
+                inc(nz[ZS[i]])
+            openmp.omp_unset_lock(&lock)
+            free(old_z)
 
-cpdef double _loglikelihood(int[:, :] nzw, int[:, :] ndz, int[:] nz, int[:] nd, double alpha, double eta) nogil:
-    cdef int k, d
+        free(local_nwz)
+        free(local_nz)
+    openmp.omp_destroy_lock(&lock)
+    free(qw)
+    free(alias_prob)
+    free(alias_idx)
+
+
+cpdef double _loglikelihood(int[:, ::1] nwz, int[:, ::1] ndz, int[::1] nz, int[::1] nd, double alpha, double eta) nogil:
+    cdef int k, d, w
     cdef int D = ndz.shape[0]
     cdef int n_topics = ndz.shape[1]
-    cdef int vocab_size = nzw.shape[1]
+    cdef int vocab_size = nwz.shape[0]
 
     cdef double ll = 0
 
@@ -95,10 +248,11 @@ cpdef double _loglikelihood(int[:, :] nzw, int[:, :] ndz, int[:] nz, int[:] nd,
         ll += n_topics * lgamma(eta * vocab_size)
         for k in range(n_topics):
             ll -= lgamma(eta * vocab_size + nz[k])
-            for w in range(vocab_size):
-                # if nzw[k, w] == 0 addition and subtraction cancel out
-                if nzw[k, w] > 0:
-                    ll += lgamma(eta + nzw[k, w]) - lgamma_eta
+        for w in range(vocab_size):
+            for k in range(n_topics):
+                # if nwz[w, k] == 0 addition and subtraction cancel out
+                if nwz[w, k] > 0:
+                    ll += lgamma(eta + nwz[w, k]) - lgamma_eta
 
         # calculate log p(z)
         for d in range(D):
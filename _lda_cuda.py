@@ -0,0 +1,84 @@
+# coding=utf-8
+"""CUDA Gibbs sampling kernel, one thread per document
+
+Requires numba built with CUDA support and a visible CUDA device.
+"""
+
+from numba import cuda
+
+
+@cuda.jit
+def _sample_topics_kernel(WS, ZS, nwz, ndz, nz, alpha, eta, eta_sum, rands,
+                          lamda, topic_word_new, doc_starts):
+    d = cuda.grid(1)
+    if d >= doc_starts.shape[0] - 1:
+        return
+    n_topics = nz.shape[0]
+    n_rand = rands.shape[0]
+    for i in range(doc_starts[d], doc_starts[d + 1]):
+        w = WS[i]
+        z = ZS[i]
+        cuda.atomic.sub(nwz, (w, z), 1)
+        ndz[d, z] -= 1
+        cuda.atomic.sub(nz, z, 1)
+
+        total = 0.0
+        for k in range(n_topics):
+            total += (lamda * (nwz[w, k] + eta[w]) / (nz[k] + eta_sum)
+                      + (1 - lamda) * topic_word_new[k, w]) * (ndz[d, k] + alpha[k])
+
+        # second pass instead of a per-thread cumulative array
+        r = rands[i % n_rand] * total
+        z_new = n_topics - 1
+        acc = 0.0
+        for k in range(n_topics):
+            acc += (lamda * (nwz[w, k] + eta[w]) / (nz[k] + eta_sum)
+                    + (1 - lamda) * topic_word_new[k, w]) * (ndz[d, k] + alpha[k])
+            if acc >= r:
+                z_new = k
+                break
+
+        ZS[i] = z_new
+        cuda.atomic.add(nwz, (w, z_new), 1)
+        ndz[d, z_new] += 1
+        cuda.atomic.add(nz, z_new, 1)
+
+
+class GPUSampler:
+    """Keeps the corpus and count matrices resident on the device across sweeps
+
+    Only the random variates and the guided distribution are uploaded per
+    sweep; the updated counts and assignments are copied back afterwards so
+    the host-side refresh logic keeps reading ordinary numpy arrays. Count
+    updates use device atomics, so concurrently sampled documents see
+    slightly stale counts — the usual approximation in GPU LDA samplers.
+    """
+
+    def __init__(self, WS, ZS, nwz, ndz, nz, alpha, eta, doc_starts, lamda,
+                 n_threads=128):
+        self.lamda = lamda
+        self.eta_sum = float(eta.sum())
+        self.n_threads = n_threads
+        n_docs = doc_starts.shape[0] - 1
+        self.n_blocks = (n_docs + n_threads - 1) // n_threads
+        self.d_WS = cuda.to_device(WS)
+        self.d_ZS = cuda.to_device(ZS)
+        self.d_nwz = cuda.to_device(nwz)
+        self.d_ndz = cuda.to_device(ndz)
+        self.d_nz = cuda.to_device(nz)
+        self.d_alpha = cuda.to_device(alpha)
+        self.d_eta = cuda.to_device(eta)
+        self.d_doc_starts = cuda.to_device(doc_starts)
+
+    def sample(self, ZS, nwz, ndz, nz, rands, topic_word_new):
+        """Run one full sweep on the device and sync the results back"""
+        d_rands = cuda.to_device(rands)
+        d_topic_word_new = cuda.to_device(topic_word_new)
+        _sample_topics_kernel[self.n_blocks, self.n_threads](
+            self.d_WS, self.d_ZS, self.d_nwz, self.d_ndz, self.d_nz,
+            self.d_alpha, self.d_eta, self.eta_sum, d_rands, self.lamda,
+            d_topic_word_new, self.d_doc_starts)
+        self.d_ZS.copy_to_host(ZS)
+        self.d_nwz.copy_to_host(nwz)
+        self.d_ndz.copy_to_host(ndz)
+        self.d_nz.copy_to_host(nz)
@@ -3,13 +3,12 @@
 
 from __future__ import absolute_import, division, unicode_literals  # noqa
 import logging
+import os
 import sys
 
 import numpy as np
-from scipy.spatial.distance import cosine
-import random
-import math
-import heapq
+import scipy.sparse
+from scipy.linalg.blas import saxpy
 import tqdm
 
 import lda._lda
@@ -42,6 +41,10 @@ class LDA:
     random_state : int or RandomState, optional
         The generator used for the initial topics.
 
+    use_gpu : bool, default False
+        Run the Gibbs sweep on the GPU via numba.cuda, one thread per
+        document. Falls back to the CPU kernel when CUDA is unavailable.
+
     Attributes
     ----------
     `components_` : array, shape = [n_topics, n_features]
@@ -50,6 +53,9 @@ class LDA:
         Alias for `components_`
     `nzw_` : array, shape = [n_topics, n_features]
         Matrix of counts recording topic-word assignments in final iteration.
+        Transpose view of `nwz_`.
+    `nwz_` : array, shape = [n_features, n_topics]
+        Word-major storage of the topic-word counts (contiguous per word).
     `ndz_` : array, shape = [n_samples, n_topics]
         Matrix of counts recording document-topic assignments in final iteration.
     `doc_topic_` : array, shape = [n_samples, n_features]
@@ -97,7 +103,7 @@ class LDA:
     """
 
     def __init__(self, n_topics, wv, id2word, n_iter=2000, alpha=0.1, eta=0.01, lamda=0.5, random_state=None,
-                 refresh=10):
+                 refresh=10, use_gpu=False):
         self.n_topics = n_topics
         self.n_iter = n_iter
         self.alpha = alpha
@@ -105,6 +111,7 @@ class LDA:
         self.lamda = lamda
         self.wv = wv
         self.id2word = id2word
+        self.use_gpu = use_gpu
         # if random_state is None, check_random_state(None) does nothing
         # other than return the current numpy RandomState
         self.random_state = random_state
@@ -192,11 +199,20 @@ class LDA:
             # in case user passes a (non-sparse) array of shape (n_features,)
             # turn it into an array of shape (1, n_features)
             X = np.atleast_2d(X)
+        if scipy.sparse.issparse(X):
+            X = X.tocsr()
         doc_topic = np.empty((X.shape[0], self.n_topics))
         WS, DS = lda.utils.matrix_to_lists(X)
-        # TODO: this loop is parallelizable
-        for d in np.unique(DS):
-            doc_topic[d] = self._transform_single(WS[DS == d], max_iter, tol)
+        # batch documents of equal length so each fixed-point update runs as
+        # a handful of array operations instead of one Python call per doc
+        lengths = np.bincount(DS, minlength=X.shape[0])
+        for length in np.unique(lengths):
+            if length == 0:
+                continue
+            docs = np.where(lengths == length)[0]
+            # DS is sorted, so the tokens of each doc are contiguous
+            W_batch = WS[np.isin(DS, docs)].reshape(len(docs), length)
+            doc_topic[docs] = self._transform_batch(W_batch, max_iter, tol)
         return doc_topic
 
     def _transform_single(self, doc, max_iter, tol):
@@ -223,9 +239,13 @@ class LDA:
 
         """
         PZS = np.zeros((len(doc), self.n_topics))
+        pseudo = np.empty_like(PZS)  # reused buffer for the pseudocount factor
         for iteration in range(max_iter + 1):  # +1 is for initialization
             PZS_new = self.components_[:, doc].T
-            PZS_new *= (PZS.sum(axis=0) - PZS + self.alpha)
+            colsum = PZS.sum(axis=0)
+            colsum += self.alpha
+            np.subtract(colsum, PZS, out=pseudo)
+            PZS_new *= pseudo
             PZS_new /= PZS_new.sum(axis=1)[:, np.newaxis]  # vector to single column matrix
             delta_naive = np.abs(PZS_new - PZS).sum()
             logger.debug('transform iter {}, delta {}'.format(iteration, delta_naive))
@@ -236,7 +256,49 @@ class LDA:
         assert len(theta_doc) == self.n_topics
         assert theta_doc.shape == (self.n_topics,)
         return theta_doc
-    
+
+    def _transform_batch(self, docs, max_iter, tol):
+        """Transform a batch of equal-length documents according to the previously fit model
+
+        Parameters
+        ----------
+        docs : 2D numpy array of integers, shape (n_docs, doc_length)
+            Each row holds the word indices of one document
+        max_iter : int
+            Maximum number of iterations in iterated-pseudocount estimation.
+        tol: double
+            Tolerance value used in stopping condition.
+
+        Returns
+        -------
+        doc_topic : 2D numpy array, shape (n_docs, n_topics)
+            Point estimate of the topic distributions for each document
+
+        Note
+        ----
+
+        See Note in `transform` documentation.
+
+        """
+        PZS = np.zeros((docs.shape[0], docs.shape[1], self.n_topics))
+        pseudo = np.empty_like(PZS)  # reused buffer for the pseudocount factor
+        for iteration in range(max_iter + 1):  # +1 is for initialization
+            PZS_new = self.components_.T[docs]
+            colsum = PZS.sum(axis=1, keepdims=True)
+            colsum += self.alpha
+            np.subtract(colsum, PZS, out=pseudo)
+            PZS_new *= pseudo
+            PZS_new /= PZS_new.sum(axis=2, keepdims=True)
+            delta_naive = np.abs(PZS_new - PZS).sum(axis=(1, 2))
+            logger.debug('transform iter {}, delta {}'.format(iteration, delta_naive.max()))
+            PZS = PZS_new
+            if (delta_naive < tol).all():
+                break
+        theta_doc = PZS.sum(axis=1)
+        theta_doc /= theta_doc.sum(axis=1)[:, np.newaxis]
+        assert theta_doc.shape == (docs.shape[0], self.n_topics)
+        return theta_doc
+
     def perplexity(self, X):
         """Calculate the perplexity score of the topic model
 
@@ -246,19 +308,18 @@ class LDA:
             Training vector, where n_samples in the number of samples and
             n_features is the number of features. Sparse matrix allowed.
         """
-        N = int(X.sum())
-        sum = 0
-        for d in range(X.shape[0]):
-            prob_doc = 0.0 # the probablity of the doc
-            for i in range(X.shape[1]):
-                if X[d,i] != 0:
-                    prob_word = 0 # the probablity of the word
-                    for k in range(self.n_topics):
-                        # cal p(w) = sumz(p(z|d)*p(w|z))
-                        prob_word += self.doc_topic_[d,k] * self.topic_word_[k,i]
-                    prob_doc += X[d,i] * math.log(prob_word)
-            sum += prob_doc
-        perplexity_score = math.exp(-sum/N)
+        N = X.sum()
+        # cal p(w) = sumz(p(z|d)*p(w|z)) for all docs and words with one matmul
+        prob_word = self.doc_topic_ @ self.topic_word_
+        if scipy.sparse.issparse(X):
+            # only take the log at the nnz positions, never densifying X
+            X = X.tocsr()
+            rows = np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
+            log_prob = np.sum(X.data * np.log(prob_word[rows, X.indices]))
+        else:
+            mask = X != 0
+            log_prob = np.sum(X[mask] * np.log(prob_word[mask]))
+        perplexity_score = np.exp(-log_prob / N)
         return perplexity_score
 
     def _fit(self, X):
@@ -272,10 +333,26 @@ class LDA:
         """
         random_state = lda.utils.check_random_state(self.random_state)
         rands = self._rands.copy()
+        if scipy.sparse.issparse(X):
+            # convert once so matrix_to_lists and the X.sum() calls hit the CSR fast path
+            X = X.tocsr()
         self._initialize(X)
+        D, W = X.shape #循环里反复取X.sum()/X.shape没有必要，提前取好
+        #偶数轮刷新用的缓冲区在循环外一次分配，循环内就地复用
+        components = np.empty((self.n_topics, W), dtype=np.float32)
+        topic_word_new = np.empty_like(components)
+        ck = np.zeros((self.n_topics), dtype=float)
+        #第三维只在行号对应的主题处被读写，去掉该维后按布尔出现矩阵存储即可
+        present = np.zeros((self.n_topics*12, D), dtype=bool)
+        #词表到高频词列号的查找表，pos[z,w]为w在主题z的12个高频词中的位置，不在则为-1
+        pos = np.full((self.n_topics, W), -1, dtype=np.int32)
+        topic_rows = np.arange(self.n_topics)[:, np.newaxis]
+        col_range = np.arange(12)
+        m_idx, l_idx = np.tril_indices(12, -1)
+        prev_topic_most = None
         for it in tqdm.tqdm(range(self.n_iter)):
-            # FIXME: using numpy.roll with a random shift might be faster
-            random_state.shuffle(rands)
+            # rolling by a random offset decorrelates iterations without an O(n log n) shuffle
+            rands = np.roll(rands, random_state.randint(len(rands)))
             if it % self.refresh == 0:
                 ll = self.loglikelihood()
                 #logger.info("<{}> log likelihood: {:.0f}".format(it, ll))
@@ -285,33 +362,35 @@ class LDA:
 
             #woc2vec引导
             if it%2 == 0:
-                self.components_ = (self.nzw_ + self.eta).astype(float)
-                self.components_ /= np.sum(self.components_, axis=1)[:, np.newaxis]
-                topic_word_ = self.components_ # topic * word
-                self.topic_word_new = self.components_
+                #nzw_是转置视图，np.add(out=...)就地重建，components缓冲保持C连续
+                np.add(self.nzw_, self.eta, out=components)
+                components /= np.sum(components, axis=1)[:, np.newaxis]
+                self.components_ = components
+                topic_word_ = components # topic * word
+                #引导矩阵必须是独立副本，调整时不能改动components_
+                np.copyto(topic_word_new, components)
+                self.topic_word_new = topic_word_new
                 #计算主题内一致性
-                topic_most = np.zeros((self.n_topics, 12), dtype=int)
-                ck = np.zeros((self.n_topics), dtype=float)
-                count = np.zeros((self.n_topics*12, X.shape[0], self.n_topics), dtype=float)
-                for i in range(self.n_topics):
-                    topic_most[i] = topic_word_[i].argsort()[::-1][0:12]
-                word_id = topic_most.tolist()
-                for i in range(int(X.sum())):
-                    w, d, z = self.WS[i], self.DS[i], self.ZS[i]
-                    if w in word_id[z]:
-                        count[word_id[z].index(w) + 12*z,d,z] += 1
+                #argpartition先选出无序的前12个词，再只对这12个排序保持降序
+                topic_most = np.argpartition(topic_word_, -12, axis=1)[:, -12:]
+                order = np.argsort(np.take_along_axis(topic_word_, topic_most, axis=1), axis=1)[:, ::-1]
+                topic_most = np.take_along_axis(topic_most, order, axis=1)
+                #只清掉上一轮写过的查找表条目，而不是整张表重置
+                if prev_topic_most is not None:
+                    pos[topic_rows, prev_topic_most] = -1
+                pos[topic_rows, topic_most] = col_range
+                prev_topic_most = topic_most
+                present[:] = False
+                cols = pos[self.ZS, self.WS]
+                valid = cols >= 0
+                present[cols[valid] + 12 * self.ZS[valid], self.DS[valid]] = True
                 for i in range(self.n_topics):
-                    for m in range(i * 12 + 1, i * 12 + 12):
-                        for l in range(i * 12, m):
-                            con_frequency = 0
-                            self_frequency = 0
-                            for d in range(X.shape[0]):
-                                #判断是否存在这两词
-                                if count[m, d, i] != 0 and count[l, d, i] != 0:
-                                    con_frequency += 1
-                                if count[l, d, i] != 0:
-                                    self_frequency += 1
-                            ck[i] += math.log((con_frequency + 1)/ self_frequency)
+                    #每个主题的12个高频词在各文档中是否出现，presence为12*D的布尔矩阵
+                    presence = present[i * 12:(i + 1) * 12]
+                    #共现文档数con_frequency[m,l]与单词文档数self_frequency[l]，一次矩阵乘即可
+                    con_frequency = presence.astype(np.int64) @ presence.T.astype(np.int64)
+                    self_frequency = presence.sum(axis=1)
+                    ck[i] = np.sum(np.log((con_frequency[m_idx, l_idx] + 1) / self_frequency[l_idx]))
                 ck_sum = np.sum(ck)
                 adjust = 0
                 ck_min = ck[0] - (ck_sum - ck[0]) / (self.n_topics - 1)
@@ -323,46 +402,21 @@ class LDA:
                     #print(ck_sum/self.n_topics)
 
                 #通过Doc2vec更新eta权重
-                min_rele = []
-                p_allocate = 0
-                p_allocate_sum = 0
-                total_embedding = np.zeros((100), dtype=float)
-                for i in range(12):
-                    total_embedding += self.wv[self.id2word[topic_most[adjust, i]]]
-                total_embedding /= 12
-                for i in range(12):
-                    min_rele.append(1 - cosine(self.wv[self.id2word[topic_most[adjust, i]]], total_embedding))
-                #min_number = heapq.nsmallest(5, m)
-                min_index = list(map(min_rele.index, heapq.nsmallest(5, min_rele))) 
-                for i in min_index:
-                    adjust_id = topic_most[adjust,i]
-                    if min_rele[i] > 0:
-                        self.topic_word_new[adjust,adjust_id] *= min_rele[i]
-                        p_allocate += self.topic_word_new[adjust, adjust_id] * (1 - min_rele[i])
-                    else:
-                        self.topic_word_new[adjust,adjust_id] *= 0
-                        p_allocate += self.topic_word_new[adjust, adjust_id]
-                for i in range(12):
-                    if i not in min_index:
-                        p_id = topic_most[adjust,i]
-                        p_allocate_sum += self.topic_word_new[adjust,p_id]
-                for i in range(12):
-                    if i not in min_index:
-                        p_id = topic_most[adjust, i]
-                        self.topic_word_new[adjust,p_id] *= (1 + p_allocate * self.topic_word_new[adjust,p_id] / p_allocate_sum)
-                #u = random.random()
+                self._adjust_topic_word_new(adjust, topic_most[adjust])
 
 
                                     
         ll = self.loglikelihood()
         logger.info("<{}> log likelihood: {:.0f}".format(self.n_iter - 1, ll))
         # note: numpy /= is integer division
-        self.components_ = (self.nzw_ + self.eta).astype(float) # topic-word
+        self.components_ = np.ascontiguousarray(self.nzw_ + self.eta, dtype=np.float32) # topic-word
         self.components_ /= np.sum(self.components_, axis=1)[:, np.newaxis]
-        self.topic_word_ = self.components_ # topic * word
         self.doc_topic_ = (self.ndz_ + self.alpha).astype(float)
         self.doc_topic_ /= np.sum(self.doc_topic_, axis=1)[:, np.newaxis]
-        self.topic_word_ = self.lamda * self.topic_word_ + (1 - self.lamda) * self.topic_word_new
+        #一次multiply加一次BLAS axpy完成lamda加权融合，不再生成两个K*V临时矩阵
+        self.topic_word_ = np.multiply(self.topic_word_new, 1 - self.lamda)
+        self.topic_word_ = saxpy(self.components_.ravel(), self.topic_word_.ravel(),
+                                 a=self.lamda).reshape(self.components_.shape)
         print(self.perplexity(X))
 
         # delete attributes no longer needed after fitting to save memory and reduce clutter
@@ -371,6 +425,50 @@ class LDA:
         del self.ZS
         return self
 
+    def _adjust_topic_word_new(self, adjust, top_words):
+        """Reweight the guided distribution of the least coherent topic
+
+        The relevance of each of the topic's 12 top words to their mean
+        embedding decides which words lose probability mass; the mass is
+        reallocated to the remaining top words.
+
+        Parameters
+        ----------
+        adjust : int
+            Index of the topic being adjusted
+        top_words : 1D numpy array of 12 word indices, highest probability first
+        """
+        p_allocate = 0
+        p_allocate_sum = 0
+        #被调整主题与其高频词未变时，直接复用上次的相关度结果
+        if (self._adjust_cache is not None and self._adjust_cache[0] == adjust
+                and np.array_equal(self._adjust_cache[1], top_words)):
+            min_rele, min_index = self._adjust_cache[2], self._adjust_cache[3]
+        else:
+            top_vecs = self._word_vecs[top_words]
+            total_embedding = top_vecs.mean(axis=0)
+            #12个词与均值向量的余弦相似度，一次矩阵乘加范数归一
+            min_rele = top_vecs @ total_embedding
+            min_rele /= np.linalg.norm(top_vecs, axis=1) * np.linalg.norm(total_embedding)
+            min_index = np.argpartition(min_rele, 5)[:5]
+            self._adjust_cache = (adjust, top_words.copy(), min_rele, min_index)
+        for i in min_index:
+            adjust_id = top_words[i]
+            if min_rele[i] > 0:
+                self.topic_word_new[adjust,adjust_id] *= min_rele[i]
+                p_allocate += self.topic_word_new[adjust, adjust_id] * (1 - min_rele[i])
+            else:
+                self.topic_word_new[adjust,adjust_id] *= 0
+                p_allocate += self.topic_word_new[adjust, adjust_id]
+        for i in range(12):
+            if i not in min_index:
+                p_id = top_words[i]
+                p_allocate_sum += self.topic_word_new[adjust,p_id]
+        for i in range(12):
+            if i not in min_index:
+                p_id = top_words[i]
+                self.topic_word_new[adjust,p_id] *= (1 + p_allocate * self.topic_word_new[adjust,p_id] / p_allocate_sum)
+
     def _initialize(self, X):
         D, W = X.shape #D为文档数，W为单词数
         N = int(X.sum()) #N为所有文档中一共出现的单词数
@@ -382,41 +480,73 @@ class LDA:
         logger.info("n_topics: {}".format(n_topics))
         logger.info("n_iter: {}".format(n_iter))
 
-        self.nzw_ = nzw_ = np.zeros((n_topics, W), dtype=np.intc) #主题-单词矩阵
+        #单词在前、主题在后的连续布局，采样核按主题扫描时即是连续内存
+        self.nwz_ = nwz_ = np.zeros((W, n_topics), dtype=np.intc) #单词-主题矩阵
+        self.nzw_ = nwz_.T #主题-单词矩阵（nwz_的转置视图）
         self.ndz_ = ndz_ = np.zeros((D, n_topics), dtype=np.intc) #文档-主题矩阵
         self.nz_ = nz_ = np.zeros(n_topics, dtype=np.intc) #nz表示第i个主题下出现的词的个数
         self.WS, self.DS = WS, DS = lda.utils.matrix_to_lists(X) #WS是第i个词对应的id，DS是第i个词对应的docid
         self.ZS = ZS = np.empty_like(self.WS, dtype=np.intc) #ZS是第i个词对应的topicid
 
+        #把词向量按词id预先排成矩阵，循环里直接按id取行，省去逐词查wv
+        self._word_vecs = np.asarray([self.wv[self.id2word[w]] for w in range(W)], dtype=np.float32)
+
+        #按文档边界把词序列切成若干块，采样核按块并行（每块的文档互不相交）
+        n_chunks = min(D, os.cpu_count() or 1)
+        doc_split = np.linspace(0, D, n_chunks + 1).astype(np.intc)
+        self._chunk_starts = np.searchsorted(DS, doc_split).astype(np.intc)
+        #每篇文档首个词的偏移，采样核的文档侧提议按它取词
+        self._doc_starts = np.searchsorted(DS, np.arange(D + 1)).astype(np.intc)
+
         #初始化引导矩阵
-        self.components_ = (self.nzw_ + self.eta).astype(float)
+        self.components_ = np.ascontiguousarray(self.nzw_ + self.eta, dtype=np.float32)
         self.components_ /= np.sum(self.components_, axis=1)[:, np.newaxis]
-        self.topic_word_new = self.components_
+        self.topic_word_new = self.components_.copy()
         np.testing.assert_equal(N, len(WS))
-        for i in range(N):
-            w, d = WS[i], DS[i]
-            z_new = i % n_topics
-            ZS[i] = z_new
-            ndz_[d, z_new] += 1
-            nzw_[z_new, w] += 1
-            nz_[z_new] += 1
+        #初始主题轮流分配，计数矩阵用add.at/bincount一次算完
+        ZS[:] = np.arange(N) % n_topics
+        np.add.at(ndz_, (DS, ZS), 1)
+        np.add.at(nwz_, (WS, ZS), 1)
+        nz_[:] = np.bincount(ZS, minlength=n_topics)
         self.loglikelihoods_ = []
+        #上一次被调整主题的(编号, 高频词, 相关度, 待调整位置)缓存
+        self._adjust_cache = None
+        self._gpu_sampler = None
 
     def loglikelihood(self):
         """Calculate complete log likelihood, log p(w,z)
 
         Formula used is log p(w,z) = log p(w|z) + log p(z)
         """
-        nzw, ndz, nz = self.nzw_, self.ndz_, self.nz_
+        nwz, ndz, nz = self.nwz_, self.ndz_, self.nz_
         alpha = self.alpha
         eta = self.eta
         nd = np.sum(ndz, axis=1).astype(np.intc)
-        return lda._lda._loglikelihood(nzw, ndz, nz, nd, alpha, eta)
+        return lda._lda._loglikelihood(nwz, ndz, nz, nd, alpha, eta)
 
     def _sample_topics(self, rands):
         """Samples all topic assignments. Called once per iteration."""
         n_topics, vocab_size = self.nzw_.shape
         alpha = np.repeat(self.alpha, n_topics).astype(np.float64)
         eta = np.repeat(self.eta, vocab_size).astype(np.float64)
-        lda._lda._sample_topics(self.WS, self.DS, self.ZS, self.nzw_, self.ndz_, self.nz_,
-                                alpha, eta, rands, self.lamda, self.topic_word_new)
+        if self.use_gpu:
+            if self._gpu_sampler is None:
+                try:
+                    from lda import _lda_cuda
+                except ImportError:
+                    _lda_cuda = None
+                #numba装了但没有CUDA设备时import照样成功，必须再查is_available
+                if _lda_cuda is None or not _lda_cuda.cuda.is_available():
+                    logger.warning("numba.cuda unavailable, falling back to the CPU kernel")
+                    self.use_gpu = False
+                else:
+                    self._gpu_sampler = _lda_cuda.GPUSampler(
+                        self.WS, self.ZS, self.nwz_, self.ndz_, self.nz_,
+                        alpha, eta, self._doc_starts, self.lamda)
+            if self._gpu_sampler is not None:
+                self._gpu_sampler.sample(self.ZS, self.nwz_, self.ndz_, self.nz_,
+                                         rands, self.topic_word_new)
+                return
+        lda._lda._sample_topics(self.WS, self.DS, self.ZS, self.nwz_, self.ndz_, self.nz_,
+                                alpha, eta, rands, self.lamda, self.topic_word_new,
+                                self._chunk_starts, self._doc_starts)
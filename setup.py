@@ -1,4 +1,7 @@
-from setuptools import setup
+from setuptools import setup, Extension
 from Cython.Build import cythonize
 
-setup(ext_modules=cythonize('C:\\Users\\84430\\Desktop\\lda-2.0.0\\lda\\_lda.pyx'))
\ No newline at end of file
+ext = Extension('lda._lda', ['_lda.pyx'],
+                extra_compile_args=['-fopenmp'],
+                extra_link_args=['-fopenmp'])
+setup(ext_modules=cythonize([ext]))